@@ -5,15 +5,28 @@
 
 # Import required modules
 # These should all be contained in the standard library
-from collections import OrderedDict
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+import array
+import bisect
 import datetime
 import gc
 import getopt
+import hashlib
+import heapq
+import io
 import itertools
+import json
 import locale
+import math
+import mmap
 import os
 import re
+import stat
+import struct
 import sys
+import time
+import zipfile
 
 # Set locale to assist with sorting
 locale.setlocale(locale.LC_ALL, '')
@@ -29,9 +42,18 @@ LEADER_LENGTH, DIRECTORY_ENTRY_LENGTH = 24, 12
 SUBFIELD_INDICATOR, END_OF_FIELD, END_OF_RECORD = chr(0x1F), chr(0x1E), chr(0x1D)
 ALEPH_CONTROL_FIELDS = ['DB ', 'SYS']
 
-DATE_RANGES = ['Total for all years', 'Pre-Aleph implementation', 'Post-Aleph implementation',
-               'No date entered on file', 'Process year: Total', 'Process year: Pre-Aleph implementation',
-               'Process year: Post-Aleph implementation', 'Process year: No date entered on file']
+# Record index (.idx) files: a header of (magic, version, ID width, number of entries),
+# followed by entries of (ID, byte offset, length) sorted by ID
+INDEX_MAGIC, INDEX_VERSION = b'AUDITIDX', 1
+INDEX_HEADER = struct.Struct('<8sHHQ')
+
+# Named boundaries for the date entered on file (008/00-05), as (name, YYYYMMDD)
+DATE_BOUNDARIES = [('Aleph implementation', 20040601)]
+
+# Date ranges for a date boundary, where {} is the name of the boundary
+DATE_RANGES = ['Total for all years', 'Pre-{}', 'Post-{}',
+               'No date entered on file', 'Process year: Total', 'Process year: Pre-{}',
+               'Process year: Post-{}', 'Process year: No date entered on file']
 
 EXCLUSIONS = {
     'STA_FFP':      ['STA SUPPRESSED',  '932/STA suppressed and no 949/FFP'],
@@ -48,6 +70,100 @@ EXCLUSIONS = {
                                         '928/SID, 949/FFP, 952/UNO, 985 $a LDLSCP or ELECTRONIC'],
 }
 
+# Fields used by the audit itself; other fields are only decoded if an analysis plugin needs them
+AUDIT_TAGS = {'001', '008', '040', '082', '245', '260', '264', '300', '337', '538',
+              '600', '610', '611', '630', '647', '648', '650', '651', '653', '654', '655', '656', '657', '658', '662',
+              '852', '908', '913', '914', '920', '922', '928', '930', '932', '949', '952', '979', '985',
+              'CFI', 'FFP', 'FIN', 'FMT', 'LEO', 'LKR', 'SID', 'SRC', 'STA', 'UNO'}
+
+# Record methods which extract the flags used only by the exclusion rules
+FLAG_EXTRACTORS = OrderedDict([
+    ('245h', 'extract_245'),
+    ('538a', 'extract_538'),
+    ('852b', 'extract_852'),
+    ('852j', 'extract_852'),
+    ('979j', 'extract_979'),
+    ('985a', 'extract_985'),
+    ('FFP', 'extract_ffp'),
+    ('LKR', 'extract_lkr'),
+    ('930_SRC_dss', 'extract_src'),
+    ('930_SRC_lds', 'extract_src'),
+    ('930_SRC_mop', 'extract_src'),
+    ('STA', 'extract_sta'),
+])
+
+# Conditions for each exclusion category, as (name, function of record); the category applies if all hold
+EXCLUSION_RULES = OrderedDict([
+    ('STA_FFP', [
+        ('932/STA suppressed', lambda r: r.flag('STA')),
+        ('no 949/FFP', lambda r: not r.flag('FFP')),
+    ]),
+    ('979', [
+        ('979 $j N', lambda r: r.flag('979j')),
+        ('no 245 $h electronic resource', lambda r: not r.flag('245h')),
+        ('no 538 $a internet', lambda r: not r.flag('538a')),
+        ('no 852 $b', lambda r: not r.flag('852b')),
+        ('no 922/LKR $a ANA', lambda r: not r.flag('LKR')),
+        ('no 600-662', lambda r: not r.q['Subjects']),
+        ('no 082, 949/FFP, 952/UNO', lambda r: not any(f in r for f in ['082', '949', 'FFP', '952', 'UNO'])),
+    ]),
+    ('930_SRC_dss', [
+        ('930/SRC $a DSS02-04', lambda r: r.flag('930_SRC_dss')),
+        ('no 245 $h electronic resource', lambda r: not r.flag('245h')),
+        ('no 538 $a internet', lambda r: not r.flag('538a')),
+        ('no 600-662', lambda r: not r.q['Subjects']),
+        ('no 082, 260, 264, 300, 908/CFI, 920/LEO, 949/FFP, 952/UNO',
+         lambda r: not any(f in r for f in ['082', '260', '264', '300', '920', 'LEO', '908', 'CFI', '949', 'FFP',
+                                            '952', 'UNO'])),
+    ]),
+    ('930_SRC_mop', [
+        ('930/SRC $a MOP', lambda r: r.flag('930_SRC_mop')),
+        ('no 852 $j', lambda r: not r.flag('852j')),
+        ('no 600-662', lambda r: not r.q['Subjects']),
+        ('no 082, 920/LEO', lambda r: not any(f in r for f in ['082', '920', 'LEO'])),
+    ]),
+    ('930_SRC_lds', [
+        ('930/SRC $a LDS', lambda r: r.flag('930_SRC_lds')),
+        ('no 600-662', lambda r: not r.q['Subjects']),
+        ('no 082, 852, 908/CFI, 920/LEO',
+         lambda r: not any(f in r for f in ['082', '852', '920', 'LEO', '908', 'CFI'])),
+    ]),
+    ('other', [
+        ('LDR/17 not 5', lambda r: r.leader[17] != '5'),
+        ('no 985 $a LDLSCP or ELECTRONIC', lambda r: not r.flag('985a')),
+        ('no 600-662', lambda r: not r.q['Subjects']),
+        ('no 082, 852, 913/FIN, 922/LKR, 928/SID, 949/FFP, 952/UNO',
+         lambda r: not any(f in r for f in ['082', '852', '913', 'FIN', '922', 'LKR', '928', 'SID', '949', 'FFP',
+                                            '952', 'UNO'])),
+    ]),
+])
+
+# Number of records for which the exclusion rule conditions are timed, before they are reordered
+RULE_SAMPLE = 10000
+
+# Types of error counted in the error file, identified by the text of the message
+ERROR_TYPES = [
+    ('Records without ID',                  re.compile(r'^Record without ID')),
+    ('Invalid leader positions',            re.compile(r'has invalid LDR position')),
+    ('Strange years of publication',        re.compile(r'year of publication')),
+    ('Duplicate record IDs',                re.compile(r'uplicate record ID')),
+    ('Bad record data',                     re.compile(r'^Bad record data')),
+    ('Records with invalid characters',     re.compile(r'invalid characters')),
+]
+
+# Numeric record IDs of up to this many digits are checked for duplicates using a bitmap
+# (of at most 125 MB for each length of ID); longer IDs are checked in the same way as non-numeric IDs
+ID_BITMAP_DIGITS = 9
+ID_HASH_SIZE = 8
+# Number of hashes sorted at a time at the end of the pass
+ID_SORT_BLOCK = 2 ** 20
+
+# Partial result (.zip) files: a header partial.json, with the counts from the audit of a set of files,
+# and a file exclusions/CATEGORY.txt for each exclusion category, listing the record IDs in sorted order;
+# if duplicates were checked, also the ID index: a bitmap ids/numeric-LENGTH.bin for each length of numeric ID,
+# and the distinct 64-bit hashes of the other IDs in sorted order (as 8-byte big-endian integers) in ids/hashed.bin
+PARTIAL_FORMAT, PARTIAL_VERSION = 'audit-partial', 1
+
 LEADER_VALIDATION = [[], [], [], [], [],
                      ['a', 'c', 'd', 'n', 'p'],
                      ['a', 'c', 'd', 'e', 'f', 'g', 'i', 'j', 'k', 'm', 'o', 'p', 'r', 't'],
@@ -95,6 +211,10 @@ class BaseAddressError(Exception):
     def __str__(self): return 'Error locating base address of record'
 
 
+class IndexFileError(Exception):
+    def __str__(self): return 'Record index file is invalid'
+
+
 # ====================
 #       Classes
 # ====================
@@ -102,10 +222,20 @@ class BaseAddressError(Exception):
 
 class MARCReader(object):
 
-    def __init__(self, marc_target):
+    def __init__(self, marc_target, tags=None, tolerant=False, error_file=None):
         super(MARCReader, self).__init__()
         if hasattr(marc_target, 'read') and callable(marc_target.read):
             self.file_handle = marc_target
+        # Tags of the fields to decode (all fields if None)
+        self.tags = tags
+        # Byte offset of the next record
+        self.offset = 0
+        # In tolerant mode, bad records are logged to error_file and skipped,
+        # and invalid bytes within fields are replaced
+        self.tolerant = tolerant
+        self.error_file = error_file
+        # Data read ahead of the next record while resynchronising
+        self.pending = b''
 
     def __iter__(self):
         return self
@@ -116,49 +246,116 @@ class MARCReader(object):
             self.file_handle = None
 
     def __next__(self):
-        first5 = self.file_handle.read(5)
+        if self.tolerant: return self.next_tolerant()
+        first5 = self.read(5)
         if not first5: raise StopIteration
         if len(first5) < 5: raise RecordLengthError
-        return Record(first5 + self.file_handle.read(int(first5) - 5))
+        data = first5 + self.read(int(first5) - 5)
+        record = Record(data, tags=self.tags)
+        record.offset = self.offset
+        self.offset += len(data)
+        return record
+
+    def next_tolerant(self):
+        """Return the next record which can be read, skipping over any bad data"""
+        while True:
+            data = self.read(5)
+            if not data: raise StopIteration
+            try:
+                if len(data) < 5 or not data.isdigit() or int(data) <= LEADER_LENGTH: raise RecordLengthError
+                data += self.read(int(data) - 5)
+                if len(data) < int(data[:5]) or data[-1:] != END_OF_RECORD.encode('ascii'):
+                    raise RecordLengthError
+                record = Record(data, tags=self.tags, errors='replace')
+            except (RecordLengthError, LeaderError, DirectoryError, FieldsError, BaseAddressLengthError,
+                    BaseAddressError, IndexError, ValueError) as err:
+                skipped = self.resync(data)
+                self.log('Bad record data ({}) at byte {}: {} bytes skipped'.format(
+                    str(err) or type(err).__name__, str(self.offset), str(skipped)))
+                self.offset += skipped
+                continue
+            if record.decode_errors > 0:
+                self.log('Record at byte {} has {} field(s) with invalid characters, which have been replaced'.format(
+                    str(self.offset), str(record.decode_errors)))
+            record.offset = self.offset
+            self.offset += len(data)
+            return record
+
+    def read(self, n):
+        """Read n bytes, starting with any data read ahead while resynchronising"""
+        if not self.pending: return self.file_handle.read(n)
+        data, self.pending = self.pending[:n], self.pending[n:]
+        if len(data) < n: data += self.file_handle.read(n - len(data))
+        return data
+
+    def resync(self, data):
+        """Skip forward from the start of a bad record, given the data read from it so far,
+        to the next END_OF_RECORD followed by a plausible leader; return the number of bytes skipped"""
+        end = END_OF_RECORD.encode('ascii')
+        data += self.pending
+        self.pending = b''
+        skipped, start = 0, 1
+        while True:
+            i = data.find(end, start)
+            if i < 0:
+                skipped += len(data)
+                data, start = b'', 0
+            elif len(data) >= i + 1 + LEADER_LENGTH:
+                if self.plausible_leader(data[i + 1:i + 1 + LEADER_LENGTH]):
+                    self.pending = data[i + 1:]
+                    return skipped + i + 1
+                start = i + 1
+                continue
+            else:
+                skipped += i
+                data, start = data[i:], 0
+            more = self.file_handle.read(65536)
+            if not more: return skipped + len(data)
+            data += more
+
+    @staticmethod
+    def plausible_leader(leader):
+        """Return True if the bytes could be the leader of a record"""
+        return leader[0:5].isdigit() and leader[12:17].isdigit() \
+            and LEADER_LENGTH < int(leader[12:17]) < int(leader[0:5])
+
+    def log(self, message):
+        if self.error_file is not None:
+            self.error_file.write('{} in file {}\n'.format(message, str(getattr(self.file_handle, 'name', ''))))
 
 
 class Record(object):
     global record_count
 
-    def __init__(self, data='', leader=' ' * LEADER_LENGTH):
+    def __init__(self, data='', leader=' ' * LEADER_LENGTH, tags=None, errors='strict'):
         self.leader = '{}22{}4500'.format(leader[0:10], leader[12:20])
         self.fields = list()
         self.pos = 0
+        # Byte offset and length of the record within its file
+        self.offset, self.length = 0, len(data)
+        # Handling of invalid bytes within fields ('strict' or 'replace'), and the number of fields affected
+        self.errors, self.decode_errors = errors, 0
 
         self.ID = ''
-        self.date_entered = 'No date entered on file'
+        # Date range of the date entered on file for each date boundary
+        self.date_entered = ()
         self.pub_year = 'None'
         self.language = ''
         self.pub_country = ''
         self.FMT, self.LEO, self.MT = set(), set(), set()
 
         self.exclude = False
+        self.exclusions = []
         
+        # Flags; those used only by the exclusion rules are extracted when first needed (see flag())
         self.q = {
             'pub_year': False, 
             'language': False, 
             'pub_country': False,
-            '245h': False,
-            '538a': False,
-            '852b': False,
-            '852j': False,
-            '979j': False,
-            '985a': False,
-            'FFP': False,
-            'LKR': False,
-            '930_SRC_dss': False,
-            '930_SRC_lds': False,
-            '930_SRC_mop': False,
-            'STA': False,
             'Subjects': False
         }
 
-        if len(data) > 0: self.decode_marc(data)
+        if len(data) > 0: self.decode_marc(data, tags)
 
     def __str__(self):
         text_list = ['=LDR  {}'.format(self.leader)]
@@ -190,10 +387,10 @@ class Record(object):
         if len(args) == 0: return self.fields
         return [f for f in self.fields if f.tag in args]
 
-    def decode_marc(self, marc):
+    def decode_marc(self, marc, tags=None):
         # Extract record leader
         try: self.leader = marc[0:LEADER_LENGTH].decode('ascii')
-        except: print('Problem with leader at record: {}'.format(str(record_count)))
+        except UnicodeDecodeError: raise LeaderError
         if len(self.leader) != LEADER_LENGTH: raise LeaderError
 
         # Extract the byte offset where the record data starts
@@ -217,15 +414,18 @@ class Record(object):
             entry_end = entry_start + DIRECTORY_ENTRY_LENGTH
             entry = directory[entry_start:entry_end]
             entry_tag = entry[0:3]
+            if tags is not None and entry_tag not in tags:
+                field_count += 1
+                continue
             entry_length = int(entry[3:7])
             entry_offset = int(entry[7:12])
             entry_data = marc[base_address + entry_offset:base_address + entry_offset + entry_length - 1]
 
             # Check if tag is a control field
             if str(entry_tag) < '010' and entry_tag.isdigit():
-                field = Field(tag=entry_tag, data=entry_data.decode('utf-8'))
+                field = Field(tag=entry_tag, data=self.decode(entry_data))
             elif str(entry_tag) in ALEPH_CONTROL_FIELDS:
-                field = Field(tag=entry_tag, data=entry_data.decode('utf-8'))
+                field = Field(tag=entry_tag, data=self.decode(entry_data))
 
             else:
                 subfields = list()
@@ -233,12 +433,12 @@ class Record(object):
                 # Missing indicators are recorded as blank spaces.
                 # Extra indicators are ignored.
 
-                subs[0] = subs[0].decode('ascii') + '  '
+                subs[0] = self.decode(subs[0], 'ascii') + '  '
                 first_indicator, second_indicator = subs[0][0], subs[0][1]
 
                 for subfield in subs[1:]:
                     if len(subfield) == 0: continue
-                    code, data = subfield[0:1].decode('ascii'), subfield[1:].decode('utf-8', 'strict')
+                    code, data = self.decode(subfield[0:1], 'ascii'), self.decode(subfield[1:])
                     subfields.append(code)
                     subfields.append(data)
                 field = Field(
@@ -251,6 +451,204 @@ class Record(object):
 
         if field_count == 0: raise FieldsError
 
+    def decode(self, data, encoding='utf-8'):
+        """Decode bytes from a field, replacing invalid bytes unless self.errors is 'strict'"""
+        try: return data.decode(encoding)
+        except UnicodeDecodeError:
+            if self.errors == 'strict': raise
+            self.decode_errors += 1
+            return data.decode(encoding, self.errors)
+
+    def analyse(self, error_file, boundaries=None, evaluator=None):
+        """Determine the values of the flags needed for the counts, and the exclusions for the record,
+        writing any validation errors to error_file"""
+        if boundaries is None: boundaries = DATE_BOUNDARIES
+        self.date_entered = ('No date entered on file',) * len(boundaries)
+
+        # LEADER (for validation only)
+        for i, v in enumerate(LEADER_VALIDATION):
+            if v != [] and len(self.leader) >= i and self.leader[i] not in v:
+                error_file.write('Record {} has invalid LDR position {}: {}.\tSource is: {}\n'.format(
+                    self.ID, str(i), self.leader[i], str(self['040'])))
+
+        # 008
+        # Date entered on file
+        # Year of publication
+        # Language
+        # Place of publication
+        for field in self.get_fields('008'):
+            try:
+                date = re.sub(r'[^0-9]', '', field.data[0:6])
+                if int(date[:2]) <= 30: date = '20' + date
+                else: date = '19' + date
+                self.date_entered = tuple('Pre-{}'.format(name) if int(date) < boundary else 'Post-{}'.format(name)
+                                          for name, boundary in boundaries)
+            except:
+                self.date_entered = ('No date entered on file',) * len(boundaries)
+            try:
+                self.pub_year = re.sub(r'[^0-9u]', '', field.data[7:11].lower())
+                if len(self.pub_year) == 4:
+                    self.q['pub_year'] = True
+                    if 'u' in self.pub_year or self.pub_year in ['0000', '9999']:
+                        self.pub_year = 'Other'
+                    elif int(self.pub_year) > 2020:
+                        error_file.write('Record with strange year of publication: {} ({}).\tSource is: {}\n'.format(
+                            self.ID, self.pub_year, str(self['040'])))
+                    elif int(self.pub_year) < 1000:
+                        error_file.write('Record with strangely early year of publication: {} ({}).\tSource is: {}\n'.format(
+                            self.ID, self.pub_year, str(self['040'])))
+                else:
+                    self.pub_year = 'None'
+                    self.q['pub_year'] = False
+            except:
+                self.pub_year = 'None'
+                self.q['pub_year'] = False
+
+            try:
+                self.language = re.sub(r'[^a-z]', '', field.data[35:38])
+                self.q['language'] = 2 <= len(self.language) <= 3
+            except:
+                self.q['language'] = False
+
+            try:
+                self.pub_country = re.sub(r'[^a-z]', '', field.data[15:18].lower())
+                self.q['pub_country'] = 2 <= len(self.pub_country) <= 3
+            except:
+                self.q['pub_country'] = False
+
+        # 337 $a
+        # Media type
+        for field in self.get_fields('337'):
+            for subfield in field.get_subfields('a'):
+                self.MT.add(subfield.lower())
+
+        # 600-662
+        # Subjects
+        self.q['Subjects'] = any(f in self for f in ['600', '610', '611', '630', '647', '648', '650', '651',
+                                                     '653', '654', '655', '656', '657', '658', '662'])
+
+        # 914, FMT
+        # Format
+        for field in self.get_fields('914', 'FMT'):
+            for subfield in field.get_subfields('a'):
+                self.FMT.add(subfield.upper().strip())
+
+        # 920, LEO
+        # LEO (Library Export Operations) Identifier
+        for field in self.get_fields('920', 'LEO'):
+            for subfield in field.get_subfields('a'):
+                subfield = subfield.upper()
+                for s in ['MP1', 'MP15', 'MP17']:
+                    if s in subfield: self.LEO.add(s)
+
+        self.exclusions = (evaluator if evaluator is not None else RuleEvaluator()).evaluate(self)
+        self.exclude = len(self.exclusions) > 0
+
+    def flag(self, name):
+        """Return the value of a flag, extracting it from the record if this has not been done already"""
+        if name not in self.q:
+            getattr(self, FLAG_EXTRACTORS[name])()
+        return self.q[name]
+
+    def extract_245(self):
+        # 245 $h
+        self.q['245h'] = False
+        for field in self.get_fields('245'):
+            for subfield in field.get_subfields('h'):
+                if 'ELECTRONIC RESOURCE' in subfield.upper():
+                    self.q['245h'] = True
+
+    def extract_538(self):
+        # 538 $a
+        self.q['538a'] = False
+        for field in self.get_fields('538'):
+            for subfield in field.get_subfields('a'):
+                if 'INTERNET' in subfield.upper():
+                    self.q['538a'] = True
+
+    def extract_852(self):
+        # 852
+        # Shelfmark
+        self.q['852b'], self.q['852j'] = False, False
+        for field in self.get_fields('852'):
+            for subfield in field.get_subfields('b'):
+                if any(s in subfield.upper() for s in ['HMNTS', 'MAPS', 'MUSIC', 'NPL', 'OC', 'STI']):
+                    self.q['852b'] = True
+            if 'j' in field:
+                self.q['852j'] = True
+
+    def extract_lkr(self):
+        # 922, LKR
+        # Link
+        self.q['LKR'] = False
+        for field in self.get_fields('922', 'LKR'):
+            for subfield in field.get_subfields('a'):
+                if 'ANA' in subfield.upper():
+                    self.q['LKR'] = True
+
+    def extract_src(self):
+        # 930, SRC
+        # Source
+        self.q['930_SRC_dss'], self.q['930_SRC_lds'], self.q['930_SRC_mop'] = False, False, False
+        for field in self.get_fields('930', 'SRC'):
+            for subfield in field.get_subfields('a'):
+                if any(s in subfield.upper() for s in ['DSS02', 'DSS03', 'DSS04']):
+                    self.q['930_SRC_dss'] = True
+                if 'MOP' in subfield.upper():
+                    self.q['930_SRC_mop'] = True
+                if 'LDS' in subfield.upper():
+                    self.q['930_SRC_lds'] = True
+
+    def extract_sta(self):
+        # 932, STA
+        # Status
+        self.q['STA'] = False
+        for field in self.get_fields('932', 'STA'):
+            for subfield in field.get_subfields('a'):
+                if 'SUPPRESSED' in subfield.upper():
+                    self.q['STA'] = True
+
+    def extract_ffp(self):
+        # 949, FFP
+        # Flag For Publication
+        self.q['FFP'] = False
+        for field in self.get_fields('949', 'FFP'):
+            for subfield in field.get_subfields('a'):
+                if 'Y' in subfield.upper():
+                    self.q['FFP'] = True
+
+    def extract_985(self):
+        # 985
+        self.q['985a'] = False
+        for field in self.get_fields('985'):
+            for subfield in field.get_subfields('a'):
+                if any(s in subfield.upper() for s in ['LDLSCP', 'ELECTRONIC']):
+                    self.q['985a'] = True
+
+    def extract_979(self):
+        # 979
+        # Negative shelfmark
+        self.q['979j'] = False
+        for field in self.get_fields('979'):
+            for subfield in field.get_subfields('j'):
+                if 'N' in subfield.upper():
+                    self.q['979j'] = True
+
+    def counters(self):
+        """Return the contribution of the record to each OutputValues counter, in the same order"""
+        return (1,
+                int(self.q['pub_year']),
+                int(self.q['pub_country']),
+                int(self.q['language']),
+                int('082' in self),
+                int('unmediated' in self.MT),
+                int('unmediated' not in self.MT and 'computer' in self.MT),
+                int('unmediated' not in self.MT and 'computer' not in self.MT and len(self.MT) > 0),
+                int(self.q['Subjects']),
+                int('MP1' in self.LEO),
+                int('MP15' in self.LEO),
+                int('MP17' in self.LEO))
+
 
 class Field(object):
 
@@ -323,6 +721,158 @@ class Field(object):
         return False
 
 
+class BloomFilter(object):
+    """Probabilistic set of hashed items, which can give false positives but never false negatives.
+
+    The filter starts with room for capacity items at the given false positive rate;
+    each time it fills, a new filter of twice the capacity (and half the rate) is added,
+    so the overall rate stays below twice the given rate however many items are added."""
+
+    def __init__(self, capacity=2 ** 20, error_rate=0.001):
+        self.capacity, self.error_rate = capacity, error_rate
+        self.filters = []
+        self.count = 0
+        self.grow()
+
+    def grow(self):
+        """Add a new filter, sized for the next capacity and rate"""
+        capacity = self.capacity * 2 ** len(self.filters)
+        error_rate = self.error_rate / 2 ** len(self.filters)
+        size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2) // 8 * 8)
+        hashes = max(1, round(size / capacity * math.log(2)))
+        self.filters.append((bytearray(size // 8), size, hashes, capacity))
+        self.count = 0
+
+    def add(self, digest):
+        """Add an item, given as a 16-byte hash, returning True if it may have been added before"""
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:16], 'little')
+        for bits, size, hashes, capacity in self.filters:
+            if all(bits[p >> 3] & (1 << (p & 7)) for p in ((h1 + i * h2) % size for i in range(hashes))):
+                return True
+        bits, size, hashes, capacity = self.filters[-1]
+        for i in range(hashes):
+            position = (h1 + i * h2) % size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+        if self.count >= capacity: self.grow()
+        return False
+
+
+class IDIndex(object):
+    """Compact index of the record IDs seen so far, used to detect duplicates.
+
+    Numeric IDs of up to ID_BITMAP_DIGITS digits are held in a bitmap for each length of ID
+    (so that leading zeros are significant), at a cost of one bit per possible ID up to the largest seen.
+    Other IDs are held as 64-bit hashes, at a cost of 8 bytes each, and passed through a Bloom filter;
+    those which it reports as possibly seen before are kept, with their location, as candidates.
+    At the end of the pass, confirmed() returns the candidates whose hash really does occur more than once."""
+
+    def __init__(self):
+        self.bitmaps = {}
+        self.bloom = BloomFilter()
+        self.digests = array.array('Q')
+        self.candidates = []
+        self.count = 0
+        self.sorted = False
+
+    def add(self, ID, location):
+        """Add an ID to the index, returning True if it has certainly been seen before.
+
+        Returns False otherwise, including for candidates which have still to be confirmed."""
+        self.count += 1
+        if ID.isdigit() and ID.isascii() and len(ID) <= ID_BITMAP_DIGITS:
+            bitmap = self.bitmaps.setdefault(len(ID), bytearray())
+            n = int(ID)
+            byte, bit = n >> 3, 1 << (n & 7)
+            if byte >= len(bitmap):
+                # Grow by doubling, but no further than the largest ID of this length
+                limit = (10 ** len(ID) >> 3) + 1
+                bitmap.extend(bytes(min(max(byte + 1, 2 * len(bitmap)), limit) - len(bitmap)))
+            if bitmap[byte] & bit: return True
+            bitmap[byte] |= bit
+            return False
+        digest = hashlib.blake2b(ID.encode('utf-8'), digest_size=16).digest()
+        self.sorted = False
+        self.digests.append(int.from_bytes(digest[:8], 'little'))
+        if self.bloom.add(digest):
+            self.candidates.append((self.digests[-1], ID, location))
+        return False
+
+    def sort(self):
+        """Sort the hashes of the non-numeric IDs, a block at a time so that only one block
+        is held as Python integers, then merging the sorted blocks into a new array"""
+        if self.sorted: return
+        blocks = [array.array('Q', sorted(self.digests[i:i + ID_SORT_BLOCK]))
+                  for i in range(0, len(self.digests), ID_SORT_BLOCK)]
+        self.digests = array.array('Q')
+        for digest in heapq.merge(*blocks):
+            self.digests.append(digest)
+        self.sorted = True
+
+    def confirmed(self):
+        """Return the (ID, location) of each candidate whose hash occurs more than once,
+        other than the first occurrence, i.e. the repeats of an ID seen earlier (or, very rarely,
+        of another ID with the same 64-bit hash)"""
+        self.sort()
+        digests = self.digests
+        # Every repeat is a candidate; the first occurrence of an ID is a candidate only if it was a false positive
+        held = Counter(digest for digest, ID, location in self.candidates)
+        seen = Counter()
+        repeats = []
+        for digest, ID, location in self.candidates:
+            occurrences = bisect.bisect_right(digests, digest) - bisect.bisect_left(digests, digest)
+            seen[digest] += 1
+            if occurrences < 2 or (held[digest] == occurrences and seen[digest] == 1): continue
+            repeats.append((ID, location))
+        self.candidates = []
+        return repeats
+
+
+class RecordIndex(object):
+    """Table of (ID, byte offset, length) for the records in a file,
+    saved as a sorted .idx file which can be binary searched without being read into memory"""
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, record):
+        self.entries.append((record.ID.encode('utf-8'), record.offset, record.length))
+
+    def write(self, path):
+        width = max((len(e[0]) for e in self.entries), default=1)
+        entry = struct.Struct('<{}sQI'.format(str(width)))
+        with open(path, mode='wb') as ofile:
+            ofile.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, width, len(self.entries)))
+            for e in sorted(self.entries):
+                ofile.write(entry.pack(*e))
+
+    @staticmethod
+    def lookup(path, ID):
+        """Return a list of (byte offset, length) for the records with the given ID in the .idx file at path"""
+        results = []
+        with open(path, mode='rb') as ifile, mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as table:
+            if len(table) < INDEX_HEADER.size: raise IndexFileError
+            magic, version, width, count = INDEX_HEADER.unpack_from(table, 0)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION: raise IndexFileError
+            entry = struct.Struct('<{}sQI'.format(str(width)))
+            if len(table) != INDEX_HEADER.size + count * entry.size: raise IndexFileError
+            key = ID.encode('utf-8')
+            if len(key) > width: return results
+            key = key.ljust(width, b'\x00')
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = INDEX_HEADER.size + mid * entry.size
+                if table[start:start + width] < key: lo = mid + 1
+                else: hi = mid
+            while lo < count:
+                e = entry.unpack_from(table, INDEX_HEADER.size + lo * entry.size)
+                if e[0] != key: break
+                results.append((e[1], e[2]))
+                lo += 1
+        return results
+
+
 class OutputValues:
     def __init__(self):
         self.values = OrderedDict([
@@ -341,18 +891,123 @@ class OutputValues:
         ])
 
 
+class RuleEvaluator(object):
+    """Evaluates the exclusion rules for records, counting how often each condition is tested and holds.
+
+    For the first `sample` records, the time taken by each condition is also recorded.
+    The conditions of each rule are then reordered so that those which are cheapest
+    and least likely to hold are tested first.
+    Since flags are only extracted when a condition needs them, most records are
+    rejected by every rule without the remaining flags being extracted."""
+
+    def __init__(self, rules=None, sample=RULE_SAMPLE):
+        if rules is None: rules = EXCLUSION_RULES
+        # Each condition is identified by its index in keys, a list of (category, condition name)
+        self.keys = [(e, name) for e in rules for name, condition in rules[e]]
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.rules = OrderedDict((e, [(self.index[(e, name)], condition) for name, condition in rules[e]])
+                                 for e in rules)
+        self.sample = sample
+        self.records = 0
+        # Whether the conditions have been reordered, and whether counts have been loaded from partial results
+        self.reordered, self.loaded = False, False
+        # Counts and times for each condition, by index
+        self.tests, self.hits = [0] * len(self.keys), [0] * len(self.keys)
+        self.timed, self.time = [0] * len(self.keys), [0.0] * len(self.keys)
+        # Only the number of records rejected by each condition is counted as the rules are evaluated;
+        # the tests and hits are worked out from these by count(), for the records since it was last called
+        self.rejected, self.counted = [0] * len(self.keys), 0
+
+    def evaluate(self, record):
+        """Return the list of exclusion categories which apply to the record"""
+        self.records += 1
+        if self.records <= self.sample: return self.evaluate_timed(record)
+        rejected = self.rejected
+        exclusions = []
+        for e, conditions in self.rules.items():
+            for i, condition in conditions:
+                if not condition(record):
+                    rejected[i] += 1
+                    break
+            else:
+                exclusions.append(e)
+        return exclusions
+
+    def evaluate_timed(self, record):
+        """Evaluate the exclusion rules for one of the first `sample` records, timing each condition"""
+        exclusions = []
+        for e, conditions in self.rules.items():
+            for i, condition in conditions:
+                start = time.perf_counter()
+                result = condition(record)
+                self.time[i] += time.perf_counter() - start
+                self.timed[i] += 1
+                if not result:
+                    self.rejected[i] += 1
+                    break
+            else:
+                exclusions.append(e)
+        if self.records == self.sample: self.reorder()
+        return exclusions
+
+    def count(self):
+        """Add the tests and hits of each condition since the last call, given the current order of the conditions"""
+        for conditions in self.rules.values():
+            tested = self.records - self.counted
+            for i, condition in conditions:
+                self.tests[i] += tested
+                tested -= self.rejected[i]
+                self.hits[i] += tested
+                self.rejected[i] = 0
+        self.counted = self.records
+
+    def rank(self, i):
+        """Return the expected cost of testing a condition per record rejected by it"""
+        if self.timed[i] == 0: return float('inf')
+        failures = self.tests[i] - self.hits[i]
+        if failures == 0: return float('inf')
+        return (self.time[i] / self.timed[i]) * self.tests[i] / failures
+
+    def reorder(self):
+        """Sort the conditions of each rule so that the cheapest and most selective are tested first"""
+        self.count()
+        for conditions in self.rules.values():
+            conditions.sort(key=lambda c: self.rank(c[0]))
+        self.reordered = True
+
+    def report(self):
+        """Return lines describing the tests of each condition, in the order in which they are now tested"""
+        self.count()
+        lines = []
+        for e, conditions in self.rules.items():
+            lines.append('{}:'.format(EXCLUSIONS[e][0]))
+            for i, condition in conditions:
+                lines.append('\t{}\ttested {}\theld {}\tmean time {}'.format(
+                    self.keys[i][1], str(self.tests[i]), str(self.hits[i]),
+                    '{:.2f} us'.format(1e6 * self.time[i] / self.timed[i]) if self.timed[i] else 'not measured'))
+        return lines
+
+    def state(self):
+        self.count()
+        return [[e, name, self.tests[i], self.hits[i], self.timed[i], self.time[i]]
+                for i, (e, name) in enumerate(self.keys)]
+
+    def load(self, state):
+        """Add the counts and times from the state of another RuleEvaluator"""
+        for e, name, tests, hits, timed, duration in state:
+            i = self.index[(e, name)]
+            self.tests[i] += tests
+            self.hits[i] += hits
+            self.timed[i] += timed
+            self.time[i] += duration
+        self.loaded = True
+
+
 class Stats:
-    def __init__(self):
-        self.values = {
-            'Total for all years': {},
-            'Pre-Aleph implementation': {},
-            'Post-Aleph implementation': {},
-            'No date entered on file': {},
-            'Process year: Total': {},
-            'Process year: Pre-Aleph implementation': {},
-            'Process year: Post-Aleph implementation': {},
-            'Process year: No date entered on file': {},
-        }
+    def __init__(self, boundaries=None):
+        self.boundaries = boundaries if boundaries is not None else DATE_BOUNDARIES
+        # Year/format grid for one process year and date boundary, filled by expand()
+        self.values = {}
         self.fmt = set()
         self.fmt.add('All formats')
         self.exclusions = {
@@ -363,6 +1018,205 @@ class Stats:
             '930_SRC_lds': set(),
             'other': set(),
         }
+        # Number of records with duplicate IDs (None if not checked), and number of errors of each type
+        self.duplicates = None
+        self.errors = Counter()
+        # Whether the counts have been loaded from partial results
+        self.loaded = False
+        # Number of records seen for each distinct combination of
+        # (year of publication, date entered, formats, counters)
+        self.signatures = Counter()
+
+    def add(self, record):
+        """Count a record against its signature; the year/format grid is only built by expand()"""
+        self.signatures[(record.pub_year, record.date_entered, tuple(sorted(record.FMT)), record.counters())] += 1
+
+    def expand(self, process_year, boundary=None):
+        """Expand the signature counts into the year/format grid of OutputValues in self.values,
+        for the given process year and name of date boundary (by default the first)"""
+        names = [name for name, date in self.boundaries]
+        b = names.index(boundary) if boundary is not None else 0
+        ranges = date_ranges(names[b])
+        self.values = {v: {} for v in ranges}
+        for (pub_year, date_entered, formats, counters), n in self.signatures.items():
+            if pub_year not in self.values:
+                self.values[pub_year] = {}
+            date_entered = date_entered[b]
+            py = str('Process year: ' + str(date_entered))
+            for fmt in formats:
+                for v in itertools.chain([pub_year, date_entered, py], ranges):
+                    if fmt not in self.values[v]:
+                        self.values[v][fmt] = OutputValues()
+                for v in itertools.chain([pub_year, date_entered, 'Total for all years'],
+                                         ['Process year: Total', py] if pub_year == process_year else []):
+                    output = self.values[v][fmt].values
+                    for w, c in zip(output, counters):
+                        if c: output[w] += c * n
+        return self.values
+
+    def state(self):
+        return {
+            'boundaries': [[name, date] for name, date in self.boundaries],
+            'formats': sorted(self.fmt),
+            'signatures': [[pub_year, list(date_entered), list(formats), list(counters), n]
+                           for (pub_year, date_entered, formats, counters), n in self.signatures.items()],
+            'duplicates': self.duplicates,
+            'errors': dict(self.errors),
+        }
+
+    def load(self, state):
+        """Add the counts from the state of another Stats object, other than the IDs in each exclusion category
+        and the number of duplicates, which can only be found from all the IDs together"""
+        self.fmt.update(state['formats'])
+        for pub_year, date_entered, formats, counters, n in state['signatures']:
+            self.signatures[(pub_year, tuple(date_entered), tuple(formats), tuple(counters))] += n
+        self.errors.update(state['errors'])
+        self.loaded = True
+
+
+class ErrorLog(object):
+    """Error file which counts the messages written to it by type"""
+
+    def __init__(self, path, counts=None):
+        self.file_handle = open(path, mode='w', encoding='utf-8', errors='replace')
+        self.counts = counts if counts is not None else Counter()
+
+    def write(self, message):
+        for name, pattern in ERROR_TYPES:
+            if pattern.search(message):
+                self.counts[name] += 1
+                break
+        else: self.counts['Other errors'] += 1
+        self.file_handle.write(message)
+
+    def close(self):
+        self.file_handle.close()
+
+# ====================
+#   Analysis plugins
+# ====================
+
+# Registry of analysis plugin classes, by name
+PLUGINS = OrderedDict()
+
+
+def register_plugin(cls):
+    """Decorator to add an analysis plugin class to the registry"""
+    PLUGINS[cls.name] = cls
+    return cls
+
+
+class AnalysisPlugin(ABC):
+    """Base class for additional analyses, run in the same pass through the files as the audit.
+
+    Subclasses declare the tags of the fields they need decoded, and must implement update(),
+    which is called for each record once it has been analysed, merge(), which combines
+    the results of another instance (e.g. from another process or another set of files),
+    state() and load(), which convert the results to and from JSON-serialisable values,
+    and write(), which saves the results to the output folder.
+    Flags are only extracted when first needed, so plugins must read them with record.flag(name),
+    rather than from record.q."""
+    name = ''
+    description = ''
+    tags = set()
+
+    @abstractmethod
+    def update(self, record):
+        raise NotImplementedError
+
+    @abstractmethod
+    def merge(self, other):
+        raise NotImplementedError
+
+    @abstractmethod
+    def state(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load(self, state):
+        raise NotImplementedError
+
+    @abstractmethod
+    def write(self, output_folder, now):
+        raise NotImplementedError
+
+
+class CountPlugin(AnalysisPlugin):
+    """Base class for plugins which count the records included in the audit by one or more keys"""
+    headings = []
+
+    def __init__(self):
+        self.counts = Counter()
+
+    @abstractmethod
+    def keys(self, record):
+        """Return the keys (tuples of strings, one for each heading) under which the record is counted"""
+        raise NotImplementedError
+
+    def update(self, record):
+        if record.exclude: return
+        for key in set(self.keys(record)):
+            self.counts[key] += 1
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+
+    def state(self):
+        return [list(key) + [n] for key, n in self.counts.items()]
+
+    def load(self, state):
+        self.counts = Counter({tuple(item[:-1]): item[-1] for item in state})
+
+    def write(self, output_folder, now):
+        ofile = open(os.path.join(output_folder, 'Catalogue audit {} {}.tsv'.format(self.name, now)),
+                     mode='w', encoding='utf-8', errors='replace')
+        ofile.write('\t'.join(self.headings) + '\tRecords\n')
+        for key in sorted(self.counts):
+            ofile.write('\t'.join(key) + '\t{}\n'.format(str(self.counts[key])))
+        ofile.close()
+
+
+@register_plugin
+class SourcePlugin(CountPlugin):
+    name = '040'
+    description = 'Records by 040 $a (original cataloguing agency)'
+    tags = {'040'}
+    headings = ['040 $a']
+
+    def keys(self, record):
+        for field in record.get_fields('040'):
+            for subfield in field.get_subfields('a'):
+                yield subfield.strip(),
+        if '040' not in record:
+            yield 'None',
+
+
+@register_plugin
+class SubjectLanguagePlugin(CountPlugin):
+    name = '6XX by language'
+    description = 'Records with each subject (6XX) tag, by language (008/35-37)'
+    tags = {'600', '610', '611', '630', '647', '648', '650', '651', '653', '654', '655', '656', '657', '658', '662'}
+    headings = ['Language', 'Tag']
+
+    def keys(self, record):
+        language = record.language if record.q['language'] else 'None'
+        for field in record.get_fields(*self.tags):
+            yield language, field.tag
+
+
+@register_plugin
+class MediaCountryPlugin(CountPlugin):
+    name = '337 by country'
+    description = 'Records by 337 $a (media type) and place of publication (008/15-17)'
+    tags = {'337'}
+    headings = ['Country', '337 $a']
+
+    def keys(self, record):
+        country = record.pub_country if record.q['pub_country'] else 'None'
+        for media_type in record.MT:
+            yield country, media_type
+        if len(record.MT) == 0:
+            yield country, 'None'
 
 # ====================
 #      Functions
@@ -377,6 +1231,249 @@ def exit_prompt(message=''):
     sys.exit()
 
 
+def date_ranges(boundary):
+    """Function to return the names of the date ranges for a date boundary"""
+    return [v.format(boundary) for v in DATE_RANGES]
+
+
+def parse_date_boundary(value):
+    """Function to parse a date boundary of the form NAME=YYYYMMDD"""
+    name, sep, date = value.rpartition('=')
+    try:
+        if name == '' or not re.match(r'^[0-9]{8}$', date): raise ValueError
+        datetime.datetime.strptime(date, '%Y%m%d')
+    except ValueError:
+        exit_prompt('Error: Date boundary {} should have the form NAME=YYYYMMDD'.format(value))
+    # NAME is used in the names of the output files, so must be valid in a file name on Windows
+    if re.search(r'[<>:"/\\|?*\x00-\x1f]', name) or name[-1] in ' .':
+        exit_prompt('Error: Date boundary name {} cannot contain any of < > : " / \\ | ? * '
+                    'or end with a space or full stop'.format(name))
+    return name, int(date)
+
+
+def write_data(path, stats, ranges):
+    """Function to write the year/format grid in stats.values to a TSV file"""
+    ofile = open(path, mode='w', encoding='utf-8', errors='replace')
+    ofile.write('YEAR\t' + '\t\t\t\t\t\t\t\t\t\t\t\t'.join(sorted(stats.fmt)) + '\n')
+    for i in range(0, len(stats.fmt)):
+        ofile.write('\tTotal\t008 Date\t008 Country\t008 Language\t\'082\t337 unmediated\t337 computer\tOther 337'
+                    '\t6XX\t920/LEO $a MP1\t920/LEO $a MP15\t920/LEO $a MP17')
+    ofile.write('\n')
+
+    for v in ranges:
+        ofile.write('{}\t'.format(v))
+        for fmt in sorted(stats.fmt):
+            if fmt in stats.values[v]:
+                for w in stats.values[v][fmt].values:
+                    if stats.values[v][fmt].values[w] != 0:
+                        ofile.write(str(stats.values[v][fmt].values[w]))
+                    ofile.write('\t')
+        ofile.write('\n')
+
+    for year in sorted(stats.values, reverse=True):
+        if year not in ranges:
+            ofile.write('{}\t'.format(str(year)))
+            for fmt in sorted(stats.fmt):
+                if fmt in stats.values[year]:
+                    for w in stats.values[year][fmt].values:
+                        if stats.values[year][fmt].values[w] != 0:
+                            ofile.write(str(stats.values[year][fmt].values[w]))
+                        ofile.write('\t')
+                else:
+                    for w in stats.values['Total for all years'][fmt].values:
+                        ofile.write('\t')
+            ofile.write('\n')
+    ofile.close()
+
+
+def parse_process_years(value, process_years):
+    """Function to add the process years in a comma-separated list to process_years"""
+    for year in value.split(','):
+        if not re.match(r'^[0-9]{4}$', year.strip()):
+            exit_prompt('Error: Process year {} should be a four-digit year'.format(year))
+        if year.strip() not in process_years: process_years.append(year.strip())
+    return process_years
+
+
+def default_process_years():
+    """Function to return the default process year (last year)"""
+    try: return [str(datetime.datetime.today().year - 1)]
+    except:
+        print('Cannot determine process year: default is 2015')
+        return ['2015']
+
+
+def unique(items):
+    """Generator to remove repeated items from a sorted iterable"""
+    previous = None
+    for item in items:
+        if item != previous: yield item
+        previous = item
+
+
+def write_exclusions(output_folder, exclusions):
+    """Function to write a file of record IDs for each exclusion category,
+    given a function returning the IDs in a category in sorted order;
+    returns the number of IDs in each category"""
+    counts = OrderedDict()
+    for e in EXCLUSIONS:
+        counts[e] = 0
+        path = os.path.join(output_folder, 'Exclusions - {}.tmp'.format(EXCLUSIONS[e][0]))
+        ofile = open(path, mode='w', encoding='utf-8', errors='replace')
+        for item in exclusions(e):
+            ofile.write(str(item) + '\n')
+            counts[e] += 1
+        ofile.close()
+        os.replace(path, os.path.join(output_folder, 'Exclusions - {} - {} records.txt'.format(
+            EXCLUSIONS[e][0], str(counts[e]))))
+    return counts
+
+
+def write_summary(path, now, stats, counts, total, evaluator):
+    """Function to write the summary of exclusions, duplicates, errors and exclusion rule evaluation"""
+    ofile = open(path, mode='w', encoding='utf-8', errors='replace')
+    ofile.write('Audit of Catalogue Bridge files\n{}\n==============================\n\n'
+                'Exclusions\n------------------------------\n'.format(now))
+    for e in EXCLUSIONS:
+        ofile.write('{}:\t{}\n'.format(str(counts[e]), EXCLUSIONS[e][1]))
+    ofile.write('{0}:\t932/STA suppressed and no 949/FFP\n'.format(str(counts['STA_FFP'])))
+    ofile.write('\nTotal: {0}:\t(note that some records are included in more than one exclusion category)\n'.format(
+        str(total)))
+    if stats.duplicates is not None:
+        ofile.write('\nDuplicates\n------------------------------\n'
+                    '{}:\trecords with an ID already seen {}\n'.format(
+                        str(stats.duplicates),
+                        '(in the same or another partial result)' if stats.loaded else '(see Errors.txt)'))
+    ofile.write('\nErrors\n------------------------------\n')
+    for name in sorted(stats.errors):
+        ofile.write('{}:\t{}\n'.format(str(stats.errors[name]), name))
+    if len(stats.errors) == 0:
+        ofile.write('None\n')
+    if evaluator.loaded:
+        order = '(conditions in order of expected cost per record rejected, over all the partial results)'
+    elif evaluator.reordered:
+        order = '(conditions in the order tested after the first {} records)'.format(str(evaluator.sample))
+    else:
+        order = '(conditions in the order defined, as fewer than {} records were tested)'.format(str(evaluator.sample))
+    ofile.write('\nExclusion rule evaluation\n------------------------------\n' + order + '\n')
+    ofile.write('\n'.join(evaluator.report()) + '\n')
+    ofile.close()
+
+
+def write_outputs(output_folder, stats, evaluator, plugins, process_years, exclusions, all_exclusions):
+    """Function to write the exclusion, summary, data and plugin files.
+
+    exclusions is a function returning the record IDs in an exclusion category in sorted order,
+    and all_exclusions a function returning the distinct record IDs in any category."""
+    counts = write_exclusions(output_folder, exclusions)
+    total = sum(1 for ID in all_exclusions())
+
+    now = str(datetime.datetime.now().strftime('%Y-%m-%d'))
+    write_summary(os.path.join(output_folder, 'Catalogue audit summary {}.txt'.format(now)),
+                  now, stats, counts, total, evaluator)
+
+    # Write a data file for each combination of process year and date boundary
+    for process_year, (name, date) in itertools.product(process_years, stats.boundaries):
+        stats.expand(process_year, name)
+        if len(process_years) == 1 and len(stats.boundaries) == 1:
+            path = 'Catalogue audit data {}.tsv'.format(now)
+        else:
+            path = 'Catalogue audit data {} - Process year {} - {}.tsv'.format(now, process_year, name)
+        write_data(os.path.join(output_folder, path), stats, date_ranges(name))
+
+    for plugin in plugins:
+        plugin.write(output_folder, now)
+
+
+def write_partial(path, files, stats, evaluator, plugins, id_index=None):
+    """Function to write a partial result file, to be combined with others by audit merge"""
+    header = {
+        'format': PARTIAL_FORMAT,
+        'version': PARTIAL_VERSION,
+        'created': datetime.datetime.now().isoformat(),
+        'files': [str(f) for f in files],
+        'exclusions': {e: len(stats.exclusions[e]) for e in EXCLUSIONS},
+        'stats': stats.state(),
+        'rules': evaluator.state(),
+        'plugins': {plugin.name: plugin.state() for plugin in plugins},
+        'ids': None if id_index is None else {'records': id_index.count, 'numeric': sorted(id_index.bitmaps)},
+    }
+    with zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_DEFLATED) as partial:
+        partial.writestr('partial.json', json.dumps(header))
+        for e in EXCLUSIONS:
+            with partial.open('exclusions/{}.txt'.format(e), mode='w') as ofile:
+                for item in sorted(stats.exclusions[e]):
+                    ofile.write((str(item) + '\n').encode('utf-8'))
+        if id_index is not None:
+            for length, bitmap in id_index.bitmaps.items():
+                with partial.open('ids/numeric-{}.bin'.format(length), mode='w') as ofile:
+                    ofile.write(bitmap)
+            id_index.sort()
+            with partial.open('ids/hashed.bin', mode='w') as ofile:
+                for digest in unique(id_index.digests):
+                    ofile.write(digest.to_bytes(ID_HASH_SIZE, 'big'))
+
+
+def read_partial(path):
+    """Function to read the header of a partial result file"""
+    try:
+        with zipfile.ZipFile(path) as partial:
+            header = json.loads(partial.read('partial.json').decode('utf-8'))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        exit_prompt('Error: {} is not a partial result file'.format(path))
+    if header.get('format') != PARTIAL_FORMAT:
+        exit_prompt('Error: {} is not a partial result file'.format(path))
+    if header.get('version') != PARTIAL_VERSION:
+        exit_prompt('Error: Partial result file {} has unsupported version {}'.format(
+            path, str(header.get('version'))))
+    return header
+
+
+def partial_ids(path, e):
+    """Generator of the record IDs in exclusion category e of a partial result file, in sorted order"""
+    with zipfile.ZipFile(path) as partial:
+        with partial.open('exclusions/{}.txt'.format(e)) as ifile:
+            for line in io.TextIOWrapper(ifile, encoding='utf-8'):
+                yield line.rstrip('\n')
+
+
+def partial_hashes(path):
+    """Generator of the distinct hashes of non-numeric record IDs in a partial result file, in sorted order"""
+    with zipfile.ZipFile(path) as partial:
+        with partial.open('ids/hashed.bin') as ifile:
+            for block in iter(lambda: ifile.read(ID_HASH_SIZE * 65536), b''):
+                for i in range(0, len(block), ID_HASH_SIZE):
+                    yield int.from_bytes(block[i:i + ID_HASH_SIZE], 'big')
+
+
+def count_partial_ids(paths, headers):
+    """Function to count the distinct record IDs in the ID indexes of partial result files.
+
+    The bitmaps for each length of numeric ID are combined a block at a time,
+    and the sorted hashes of the other IDs are merged as they are read."""
+    count = 0
+    for length in sorted(set().union(*(header['ids']['numeric'] for header in headers))):
+        partials = [zipfile.ZipFile(path) for path, header in zip(paths, headers)
+                    if length in header['ids']['numeric']]
+        bitmaps = [partial.open('ids/numeric-{}.bin'.format(length)) for partial in partials]
+        while True:
+            blocks = [bitmap.read(2 ** 20) for bitmap in bitmaps]
+            if not any(blocks): break
+            combined = 0
+            for block in blocks:
+                combined |= int.from_bytes(block, 'little')
+            count += bin(combined).count('1')
+        for f in bitmaps + partials: f.close()
+    count += sum(1 for digest in unique(heapq.merge(*[partial_hashes(path) for path in paths])))
+    return count
+
+
+def is_input(path):
+    """Function to check whether a path is a regular file or a named pipe (FIFO)"""
+    try: return os.path.isfile(path) or stat.S_ISFIFO(os.stat(path).st_mode)
+    except OSError: return False
+
+
 def check_file_location(file_path, function, file_ext='', exists=False):
     """Function to check whether a file exists and has the correct file extension."""
     folder, file, ext = '', '', ''
@@ -399,17 +1496,197 @@ def check_file_location(file_path, function, file_ext='', exists=False):
 def usage():
     """Function to print information about the script"""
     print('Correct syntax is:')
-    print('audit [OPTIONS]')
+    print('audit [OPTIONS] [FILE ...]')
     print('\nOptions:')
     print('    -i       INPUT_FOLDER - Path to folder containing input files.')
     print('    -o       OUTPUT_FOLDER - Path to folder to save output files.')
+    print('    -y       PROCESS_YEAR - Process year(s), separated by commas.')
+    print('    --date_boundary  NAME=YYYYMMDD - Named boundary for the date entered on file.')
+    print('    --duplicates  Check for records with duplicate IDs.')
+    print('    --index  Save a record index (.idx) alongside each input file.')
+    print('    --plugin NAME - Additional analysis to run; names may be separated by commas.')
+    print('    --tolerant  Log and skip bad records, and replace invalid characters, instead of stopping.')
+    print('    --partial  PARTIAL - Save a partial result file, to be combined by audit merge, instead of the '
+          'usual output files.')
     print('    --debug  Debug mode.')
     print('    --help   Display this help message and exit.')
     print('\nIf INPUT_FOLDER is not set, files to be audited are assumed to be present in the current folder.')
     print('If OUTPUT_FOLDER is not set, output files are created in the current folder.')
+    print('If PROCESS_YEAR is not set, the process year is last year.')
+    print('--date_boundary may be given more than once; if it is not set, the boundary is '
+          'Aleph implementation=20040601.')
+    print('NAME is used in output file names, so cannot contain any of < > : " / \\ | ? *')
+    print('A data file is created for each combination of process year and date boundary.')
+    print('\nAvailable analysis plugins:')
+    for name in PLUGINS:
+        print('    {}: {}'.format(name, PLUGINS[name].description))
     print('Files to be audited must have named of the form full*.lex, where * is a number.')
+    print('If FILE is set, only the files given are audited; FILE is relative to INPUT_FOLDER, if set.')
+    print('FILE may be a named pipe (FIFO), or - to read records from standard input.')
+    print('\nTo display records by ID, using the record indexes saved with --index:')
+    print('audit show [-i INPUT_FOLDER] [--date_boundary NAME=YYYYMMDD] ID [ID ...]')
+    print('\nTo combine partial result files into the usual output files:')
+    print('audit merge [-o OUTPUT_FOLDER] [-y PROCESS_YEAR] PARTIAL [PARTIAL ...]')
     exit_prompt()
 
+
+def merge(argv):
+    """Function to combine partial result files into the usual output files"""
+    output_folder, process_years = '', []
+
+    print('========================================')
+    print('Audit merge')
+    print('========================================')
+    print('Combine partial results from audits of the FULL catalogue in Catalogue Bridge\n')
+
+    try:
+        opts, args = getopt.getopt(argv, 'o:y:', ['output_folder=', 'process_year=', 'help'])
+    except getopt.GetoptError as err:
+        exit_prompt('Error: {}'.format(err))
+    for opt, arg in opts:
+        if opt == '--help':
+            usage()
+        elif opt in ['-o', '--output_folder']:
+            output_folder = arg
+        elif opt in ['-y', '--process_year']:
+            parse_process_years(arg, process_years)
+        else: exit_prompt('Error: Option {} not recognised'.format(opt))
+
+    if len(args) == 0:
+        exit_prompt('Error: No partial result files specified')
+    for path in args:
+        if not os.path.isfile(path):
+            exit_prompt('Error: Could not locate partial result file {}'.format(path))
+    if len(set(os.path.abspath(path) for path in args)) < len(args):
+        exit_prompt('Error: Partial result files can only be merged once')
+    if output_folder != '':
+        try:
+            if not os.path.isdir(output_folder):
+                os.makedirs(output_folder)
+        except os.error: exit_prompt('Error: Could not create folder for output files')
+        print('Output folder: {}'.format(output_folder))
+    if len(process_years) == 0: process_years = default_process_years()
+
+    print('\nStarting merge ...')
+    print('----------------------------------------')
+    print(str(datetime.datetime.now()))
+
+    headers = [read_partial(path) for path in args]
+    # Each input file may only be counted once; files are identified by name, as fullN.lex is unique in the export
+    audited = {}
+    for path, header in zip(args, headers):
+        for f in header['files']:
+            name = os.path.basename(f)
+            if f == '-': continue
+            if name in audited:
+                exit_prompt('Error: File {} was audited for both {} and {}'.format(name, audited[name], path))
+            audited[name] = path
+    boundaries = [(name, date) for name, date in headers[0]['stats']['boundaries']]
+    stats, evaluator, plugins = Stats(boundaries), RuleEvaluator(), OrderedDict()
+    for path, header in zip(args, headers):
+        print('Partial result {}: {}'.format(path, ', '.join(header['files'])))
+        if [(name, date) for name, date in header['stats']['boundaries']] != boundaries:
+            exit_prompt('Error: Partial result files have different date boundaries')
+        stats.load(header['stats'])
+        evaluator.load(header['rules'])
+        for name in header['plugins']:
+            if name not in PLUGINS:
+                exit_prompt('Error: Analysis plugin {} not recognised'.format(name))
+            plugin = PLUGINS[name]()
+            plugin.load(header['plugins'][name])
+            if name in plugins: plugins[name].merge(plugin)
+            else: plugins[name] = plugin
+    evaluator.reorder()
+
+    # Duplicates are counted from the ID indexes together, so that repeats across partial results are included
+    if all(header.get('ids') is not None for header in headers):
+        stats.duplicates = sum(header['ids']['records'] for header in headers) - count_partial_ids(args, headers)
+    elif any(header.get('ids') is not None for header in headers):
+        print('Duplicates not counted, as some partial results were not made with --duplicates')
+    # The error counts of the partial results only include the repeats within each of them
+    stats.errors.pop('Duplicate record IDs', None)
+    if stats.duplicates: stats.errors['Duplicate record IDs'] = stats.duplicates
+
+    # The exclusion IDs are merged from the sorted lists in the partial result files, without loading them all
+    write_outputs(output_folder, stats, evaluator, plugins.values(), process_years,
+                  lambda e: unique(heapq.merge(*[partial_ids(path, e) for path in args])),
+                  lambda: unique(heapq.merge(*[partial_ids(path, e) for path in args for e in EXCLUSIONS])))
+
+    print('\nMerge complete')
+    print('----------------------------------------')
+    print(str(datetime.datetime.now()))
+    sys.exit()
+
+
+def show(argv):
+    """Function to display records, with their flags and exclusions, looked up in the record indexes"""
+    input_folder, boundaries = '', []
+    try:
+        opts, args = getopt.getopt(argv, 'i:', ['input_folder=', 'date_boundary=', 'help'])
+    except getopt.GetoptError as err:
+        exit_prompt('Error: {}'.format(err))
+    for opt, arg in opts:
+        if opt == '--help':
+            usage()
+        elif opt in ['-i', '--input_folder']:
+            input_folder = arg
+        elif opt == '--date_boundary':
+            boundary = parse_date_boundary(arg)
+            if boundary[0] in [name for name, date in boundaries]:
+                exit_prompt('Error: Date boundary {} is specified more than once'.format(boundary[0]))
+            boundaries.append(boundary)
+        else: exit_prompt('Error: Option {} not recognised'.format(opt))
+    if len(boundaries) == 0: boundaries = DATE_BOUNDARIES
+
+    if len(args) == 0:
+        exit_prompt('Error: No record ID specified')
+    if input_folder != '' and not os.path.isdir(input_folder):
+        exit_prompt('Error: Could not locate folder for input files')
+    # Any index saved alongside a .lex file, as --index does for each input file
+    indexes = sorted(f for f in os.listdir(input_folder if input_folder != '' else '.')
+                     if os.path.splitext(str(f))[1] == '.idx'
+                     and os.path.isfile(os.path.join(input_folder, os.path.splitext(str(f))[0] + '.lex')))
+    if len(indexes) == 0:
+        exit_prompt('Error: No record indexes found; run audit with --index to create them')
+
+    for ID in args:
+        found = False
+        for f in indexes:
+            path = os.path.join(input_folder, f)
+            try: locations = RecordIndex.lookup(path, ID)
+            except IndexFileError as err:
+                print('Error: {}: {}'.format(str(f), err))
+                continue
+            for offset, length in locations:
+                found = True
+                with open(os.path.splitext(path)[0] + '.lex', mode='rb') as mfile:
+                    mfile.seek(offset)
+                    record = Record(mfile.read(length))
+                for field in record.get_fields('001'):
+                    record.ID = field.data
+                print('========================================')
+                print('Record {} in file {} at byte {} ({} bytes)'.format(
+                    ID, os.path.splitext(str(f))[0] + '.lex', str(offset), str(length)))
+                print('----------------------------------------')
+                print(str(record))
+                record.analyse(sys.stdout, boundaries)
+                for q in FLAG_EXTRACTORS:
+                    record.flag(q)
+                print('Date entered: {}'.format(', '.join(record.date_entered)))
+                print('Year of publication: {}'.format(record.pub_year))
+                print('Formats: {}'.format(', '.join(sorted(record.FMT))))
+                print('Flags:')
+                for q in record.q:
+                    print('    {}: {}'.format(q, str(record.q[q])))
+                print('Exclusions:')
+                for e in record.exclusions:
+                    print('    {}: {}'.format(EXCLUSIONS[e][0], EXCLUSIONS[e][1]))
+                if not record.exclusions:
+                    print('    None')
+        if not found:
+            print('Record {} not found'.format(ID))
+    sys.exit()
+
 # ====================
 #      Main code
 # ====================
@@ -417,12 +1694,17 @@ def usage():
 
 def main(argv=None):
     if argv is None: name = str(sys.argv[1])
+    if argv and argv[0] == 'show':
+        show(argv[1:])
+    if argv and argv[0] == 'merge':
+        merge(argv[1:])
 
     # Global variables
     global record_count
 
-    input_folder, output_folder = '', ''
-    debug = False
+    input_folder, output_folder, partial = '', '', ''
+    debug, duplicates, make_index, tolerant = False, False, False, False
+    process_years, boundaries, plugins = [], [], []
 
     print('========================================')
     print('Audit')
@@ -430,7 +1712,9 @@ def main(argv=None):
     print('A tool to perform an audit of the FULL catalogue in Catalogue Bridge\n')
 
     try:
-        opts, args = getopt.getopt(argv, 'i:o:', ['input_folder=', 'output_folder=', 'debug', 'help'])
+        opts, args = getopt.getopt(argv, 'i:o:y:', ['input_folder=', 'output_folder=', 'process_year=',
+                                                         'date_boundary=', 'duplicates', 'index', 'plugin=',
+                                                         'tolerant', 'partial=', 'debug', 'help'])
     except getopt.GetoptError as err:
         exit_prompt('Error: {}'.format(err))
     for opt, arg in opts:
@@ -438,10 +1722,32 @@ def main(argv=None):
             usage()
         elif opt == '--debug':
             debug = True
+        elif opt == '--duplicates':
+            duplicates = True
+        elif opt == '--index':
+            make_index = True
+        elif opt == '--tolerant':
+            tolerant = True
         elif opt in ['-i', '--input_folder']:
             input_folder = arg
         elif opt in ['-o', '--output_folder']:
             output_folder = arg
+        elif opt in ['-y', '--process_year']:
+            parse_process_years(arg, process_years)
+        elif opt == '--partial':
+            partial = arg
+        elif opt == '--date_boundary':
+            boundary = parse_date_boundary(arg)
+            if boundary[0] in [name for name, date in boundaries]:
+                exit_prompt('Error: Date boundary {} is specified more than once'.format(boundary[0]))
+            boundaries.append(boundary)
+        elif opt == '--plugin':
+            for name in arg.split(','):
+                if name.strip() not in PLUGINS:
+                    exit_prompt('Error: Analysis plugin {} not recognised; available plugins are: {}'.format(
+                        name.strip(), ', '.join(PLUGINS)))
+                if name.strip() not in [plugin.name for plugin in plugins]:
+                    plugins.append(PLUGINS[name.strip()]())
         else: exit_prompt('Error: Option {} not recognised'.format(opt))
 
     # Check file locations
@@ -462,17 +1768,30 @@ def main(argv=None):
         print('Input folder: {}'.format(input_folder))
     if output_folder != '':
         print('Output folder: {}'.format(output_folder))
+    if partial != '':
+        print('Partial result file: {}'.format(partial))
+    if duplicates:
+        print('Checking for duplicate record IDs')
+    if make_index:
+        print('Saving record indexes')
+    if tolerant:
+        print('Tolerant mode: bad records will be skipped')
+    if plugins:
+        print('Analysis plugins: {}'.format(', '.join(plugin.name for plugin in plugins)))
     if debug:
         print('Debug mode')
 
-    stats = Stats()
+    if len(boundaries) == 0: boundaries = DATE_BOUNDARIES
+    stats = Stats(boundaries)
+    evaluator = RuleEvaluator()
+    id_index = IDIndex() if duplicates else None
+    if duplicates: stats.duplicates = 0
 
-    try: process_year = str(datetime.datetime.today().year - 1)
-    except:
-        process_year = '2015'
-        print('Cannot determine process year: default is 2015')
-    if debug:
-        print('Process year: {}'.format(process_year))
+    if len(process_years) == 0: process_years = default_process_years()
+    if debug or len(process_years) > 1:
+        print('Process year: {}'.format(', '.join(process_years)))
+    if debug or boundaries != DATE_BOUNDARIES:
+        print('Date boundaries: {}'.format(', '.join('{}={}'.format(name, str(date)) for name, date in boundaries)))
 
     # --------------------
     # Main transformation
@@ -483,22 +1802,37 @@ def main(argv=None):
     print(str(datetime.datetime.now()))
 
     if debug:
-        files = [f for f in os.listdir(input_folder if input_folder != '' else '.')
-                 if os.path.isfile(f) and re.match(r'^full12\.lex$', str(f))]
+        files = [os.path.join(input_folder, f) for f in os.listdir(input_folder if input_folder != '' else '.')
+                 if re.match(r'^full12\.lex$', str(f)) and is_input(os.path.join(input_folder, f))]
     else:
-        files = [f for f in os.listdir(input_folder if input_folder != '' else '.')
-                 if os.path.isfile(f) and re.match(r'^full[0-9]+\.lex$', str(f))]
-
-    error_file = open(os.path.join(output_folder, 'Errors.txt'), mode='w', encoding='utf-8', errors='replace')
+        files = [os.path.join(input_folder, f) for f in os.listdir(input_folder if input_folder != '' else '.')
+                 if re.match(r'^full[0-9]+\.lex$', str(f)) and is_input(os.path.join(input_folder, f))]
+    if len(args) > 0:
+        # Paths are relative to the input folder, as for the files found there
+        args = [f if f == '-' else os.path.join(input_folder, f) for f in args]
+        for f in args:
+            if f != '-' and not is_input(f):
+                exit_prompt('Error: Could not locate input file {}'.format(f))
+        if args.count('-') > 1:
+            exit_prompt('Error: Standard input (-) can only be read once')
+        files = args
+
+    error_file = ErrorLog(os.path.join(output_folder, 'Errors.txt'), stats.errors)
 
     for f in files:
 
-        print('\n\nProcessing file {0} ...'.format(str(f)))
+        label = 'standard input' if f == '-' else str(f)
+        print('\n\nProcessing file {0} ...'.format(label))
         print('----------------------------------------')
         print(str(datetime.datetime.now()))
         record_count = 0
-        mfile = open(f, 'rb')
-        reader = MARCReader(mfile)
+        # Records are parsed as they arrive from standard input or a named pipe
+        mfile = sys.stdin.buffer if f == '-' else open(f, 'rb')
+        reader = MARCReader(mfile, tags=AUDIT_TAGS.union(*(plugin.tags for plugin in plugins)),
+                            tolerant=tolerant, error_file=error_file)
+        index = RecordIndex() if make_index and f != '-' and os.path.isfile(f) else None
+        if make_index and index is None:
+            print('Record index cannot be saved for {}, as it is not a regular file'.format(label))
         for record in reader:
 
             # 001
@@ -507,276 +1841,50 @@ def main(argv=None):
                 record.ID = field.data
 
             if record.ID == '':
-                error_file.write('Record without ID at position {} in file {}\n'.format(str(record_count), str(f)))
+                error_file.write('Record without ID at position {} in file {}\n'.format(str(record_count), label))
 
             if record.ID != '':
                 record_count += 1
                 if debug and record_count > 10000: break
                 print('\r{0} MARC records processed'.format(str(record_count)), end='\r')
 
-                # LEADER (for validation only)
-                for i, v in enumerate(LEADER_VALIDATION):
-                    if v != [] and len(record.leader) >= i and record.leader[i] not in v:
-                        error_file.write('Record {} has invalid LDR position {}: {}.\tSource is: {}\n'.format(
-                            record.ID, str(i), record.leader[i], str(record['040'])))
-
-                # 008
-                # Date entered on file
-                # Year of publication
-                # Language
-                # Place of publication
-                for field in record.get_fields('008'):
-                    try:
-                        date = re.sub(r'[^0-9]', '', field.data[0:6])
-                        if int(date[:2]) <= 30: date = '20' + date
-                        else: date = '19' + date
-                        if int(date) < 20040601: record.date_entered = 'Pre-Aleph implementation'
-                        else: record.date_entered = 'Post-Aleph implementation'
-                    except:
-                        record.date_entered = 'No date entered on file'
-                    try:
-                        record.pub_year = re.sub(r'[^0-9u]', '', field.data[7:11].lower())
-                        if len(record.pub_year) == 4:
-                            record.q['pub_year'] = True
-                            if 'u' in record.pub_year or record.pub_year in ['0000', '9999']:
-                                record.pub_year = 'Other'
-                            elif int(record.pub_year) > 2020:
-                                error_file.write('Record with strange year of publication: {} ({}).\tSource is: {}\n'.format(
-                                    record.ID, record.pub_year, str(record['040'])))
-                            elif int(record.pub_year) < 1000:
-                                error_file.write('Record with strangely early year of publication: {} ({}).\tSource is: {}\n'.format(
-                                    record.ID, record.pub_year, str(record['040'])))
-                        else:
-                            record.pub_year = 'None'
-                            record.q['pub_year'] = False
-                    except:
-                        record.pub_year = 'None'
-                        record.q['pub_year'] = False
-
-                    try:
-                        record.language = re.sub(r'[^a-z]', '', field.data[35:38])
-                        record.q['language'] = 2 <= len(record.language) <= 3
-                    except:
-                        record.q['language'] = False
-
-                    try:
-                        record.pub_country = re.sub(r'[^a-z]', '', field.data[15:18].lower())
-                        record.q['pub_country'] = 2 <= len(record.pub_country) <= 3
-                    except:
-                        record.q['pub_country'] = False
-
-                # 245 $h
-                for field in record.get_fields('245'):
-                    for subfield in field.get_subfields('h'):
-                        if 'ELECTRONIC RESOURCE' in subfield.upper():
-                            record.q['245h'] = True
-
-                # 337 $a
-                # Media type
-                for field in record.get_fields('337'):
-                    for subfield in field.get_subfields('a'):
-                        record.MT.add(subfield.lower())
-
-                # 538 $a
-                for field in record.get_fields('538'):
-                    for subfield in field.get_subfields('a'):
-                        if 'INTERNET' in subfield.upper():
-                            record.q['538a'] = True
-
-                # 600-662
-                # Subjects
-                record.q['Subjects'] = any(f in record for f in ['600', '610', '611', '630', '647', '648', '650', '651',
-                                                                 '653', '654', '655', '656', '657', '658', '662'])
-
-                # 852
-                # Shelfmark
-                for field in record.get_fields('852'):
-                    for subfield in field.get_subfields('b'):
-                        if any(s in subfield.upper() for s in ['HMNTS', 'MAPS', 'MUSIC', 'NPL', 'OC', 'STI']):
-                            record.q['852b'] = True
-                    if 'j' in field:
-                        record.q['852j'] = True
-
-                # 914, FMT
-                # Format
-                for field in record.get_fields('914', 'FMT'):
-                    for subfield in field.get_subfields('a'):
-                        record.FMT.add(subfield.upper().strip())
-                        stats.fmt.add(subfield.upper().strip())
-
-                # 920, LEO
-                # LEO (Library Export Operations) Identifier
-                for field in record.get_fields('920', 'LEO'):
-                    for subfield in field.get_subfields('a'):
-                        subfield = subfield.upper()
-                        for s in ['MP1', 'MP15', 'MP17']:
-                            if s in subfield: record.LEO.add(s)
-
-                # 922, LKR
-                # Link
-                for field in record.get_fields('922', 'LKR'):
-                    for subfield in field.get_subfields('a'):
-                        if 'ANA' in subfield.upper():
-                            record.q['LKR'] = True
-
-                # 930, SRC
-                # Source
-                for field in record.get_fields('930', 'SRC'):
-                    for subfield in field.get_subfields('a'):
-                        if any(s in subfield.upper() for s in ['DSS02', 'DSS03', 'DSS04']):
-                            record.q['930_SRC_dss'] = True
-                        if 'MOP' in subfield.upper():
-                            record.q['930_SRC_mop'] = True
-                        if 'LDS' in subfield.upper():
-                            record.q['930_SRC_lds'] = True
-
-                # 932, STA
-                # Status
-                for field in record.get_fields('932', 'STA'):
-                    for subfield in field.get_subfields('a'):
-                        if 'SUPPRESSED' in subfield.upper():
-                            record.q['STA'] = True
-
-                # 949, FFP
-                # Flag For Publication
-                for field in record.get_fields('949', 'FFP'):
-                    for subfield in field.get_subfields('a'):
-                        if 'Y' in subfield.upper():
-                            record.q['FFP'] = True
-
-                # 985
-                for field in record.get_fields('985'):
-                    for subfield in field.get_subfields('a'):
-                        if any(s in subfield.upper() for s in ['LDLSCP', 'ELECTRONIC']):
-                            record.q['985a'] = True
-
-                # 979
-                # Negative shelfmark
-                for field in record.get_fields('979'):
-                    for subfield in field.get_subfields('j'):
-                        if 'N' in subfield.upper():
-                            record.q['979j'] = True
-
-                if record.q['STA'] and not record.q['FFP']:
-                    record.exclude = True
-                    stats.exclusions['STA_FFP'].add(record.ID)
-
-                if record.q['979j'] \
-                   and not any(q for q in [record.q['245h'], record.q['538a'], record.q['852b'], record.q['LKR'],
-                                           record.q['Subjects']]) \
-                   and not any(f in record for f in ['082', '949', 'FFP', '952', 'UNO']):
-                    record.exclude = True
-                    stats.exclusions['979'].add(record.ID)
-
-                if record.q['930_SRC_dss'] \
-                   and not any(q for q in [record.q['245h'], record.q['538a'], record.q['Subjects']]) \
-                   and not any(f in record for f in ['082', '260', '264', '300', '920', 'LEO', '908', 'CFI', '949',
-                                                     'FFP', '952', 'UNO']):
-                    record.exclude = True
-                    stats.exclusions['930_SRC_dss'].add(record.ID)
-
-                if record.q['930_SRC_mop'] \
-                   and not any(q for q in [record.q['852j'], record.q['Subjects']]) \
-                   and not any(f in record for f in ['082', '920', 'LEO']):
-                    record.exclude = True
-                    stats.exclusions['930_SRC_mop'].add(record.ID)
-
-                if record.q['930_SRC_lds'] \
-                   and not record.q['Subjects'] and not any(f in record for f in ['082', '852', '920', 'LEO', '908',
-                                                                                  'CFI']):
-                    record.exclude = True
-                    stats.exclusions['930_SRC_lds'].add(record.ID)
-
-                if record.leader[17] != '5' \
-                   and not any(q for q in [record.q['985a'], record.q['Subjects']]) \
-                   and not any(f in record for f in ['082', '852', '913', 'FIN', '922', 'LKR', '928', 'SID',
-                                                     '949', 'FFP', '952', 'UNO']):
-                    record.exclude = True
-                    stats.exclusions['other'].add(record.ID)
+                # Duplicate IDs
+                if id_index is not None and id_index.add(record.ID, (record_count, label)):
+                    stats.duplicates += 1
+                    error_file.write('Duplicate record ID {} at position {} in file {}\n'.format(
+                        record.ID, str(record_count), label))
+
+                if index is not None:
+                    index.add(record)
+
+                record.analyse(error_file, boundaries, evaluator)
+                stats.fmt.update(record.FMT)
+                for e in record.exclusions:
+                    stats.exclusions[e].add(record.ID)
+                for plugin in plugins:
+                    plugin.update(record)
 
                 record.FMT.add('All formats')
-                py = str('Process year: ' + str(record.date_entered))
                 if record.pub_year != '' and not record.exclude:
-                    if record.pub_year not in stats.values:
-                        stats.values[record.pub_year] = {}
-
-                    for fmt in record.FMT:
-                        for v in itertools.chain([record.pub_year, record.date_entered, py], DATE_RANGES):
-                            if fmt not in stats.values[v]:
-                                stats.values[v][fmt] = OutputValues()
-                        for v in itertools.chain([record.pub_year, record.date_entered, 'Total for all years'],
-                                                 ['Process year: Total', py] if record.pub_year == process_year
-                                                 else []):
-                            stats.values[v][fmt].values['Total for all years'] += 1
-                            stats.values[v][fmt].values['008 Date'] += int(record.q['pub_year'])
-                            stats.values[v][fmt].values['008 Language'] += int(record.q['language'])
-                            stats.values[v][fmt].values['008 Country'] += int(record.q['pub_country'])
-                            stats.values[v][fmt].values['082'] += int('082' in record)
-                            stats.values[v][fmt].values['337 unmediated'] += int('unmediated' in record.MT)
-                            stats.values[v][fmt].values['337 computer'] += int('unmediated' not in record.MT
-                                                                               and 'computer' in record.MT)
-                            stats.values[v][fmt].values['Other 337'] += int('unmediated' not in record.MT
-                                                                            and 'computer' not in record.MT
-                                                                            and len(record.MT) > 0)
-                            stats.values[v][fmt].values['6XX'] += int(record.q['Subjects'])
-                            stats.values[v][fmt].values['920/LEO $a MP1'] += int('MP1' in record.LEO)
-                            stats.values[v][fmt].values['920/LEO $a MP15'] += int('MP15' in record.LEO)
-                            stats.values[v][fmt].values['920/LEO $a MP17'] += int('MP17' in record.LEO)
-        mfile.close()
+                    stats.add(record)
+        if f != '-': mfile.close()
+        if index is not None:
+            index.write(os.path.splitext(f)[0] + '.idx')
+
+    # Repeats of IDs checked by hash are only known once all the files have been read
+    if id_index is not None:
+        for ID, (position, label) in id_index.confirmed():
+            stats.duplicates += 1
+            error_file.write('Duplicate record ID {} at position {} in file {}\n'.format(ID, str(position), label))
     error_file.close()
 
-    # Create union of all exclusion categories
-    exclusions = list(set().union(*stats.exclusions.values()))
-
-    for e in EXCLUSIONS:
-        ofile = open(os.path.join(output_folder, 'Exclusions - {} - {} records.txt'.format(EXCLUSIONS[e][0], str(len(stats.exclusions[e])))),
-                     mode='w', encoding='utf-8', errors='replace')
-        for item in sorted(stats.exclusions[e]):
-            ofile.write(str(item) + '\n')
-        ofile.close()
-
-    now = str(datetime.datetime.now().strftime('%Y-%m-%d'))
-    ofile = open(os.path.join(output_folder, 'Catalogue audit summary {}.txt'.format(now)), mode='w', encoding='utf-8', errors='replace')
-    ofile.write('Audit of Catalogue Bridge files\n{}\n==============================\n\n'
-                'Exclusions\n------------------------------\n'.format(now))
-    for e in EXCLUSIONS:
-        ofile.write('{}:\t{}\n'.format(str(len(stats.exclusions[e])), EXCLUSIONS[e][1]))
-    ofile.write('{0}:\t932/STA suppressed and no 949/FFP\n'.format(str(len(stats.exclusions['STA_FFP']))))
-    ofile.write('\nTotal: {0}:\t(note that some records are included in more than one exclusion category)\n'.format(
-        str(len(exclusions))))
-    ofile.close()
-    
-    ofile = open(os.path.join(output_folder, 'Catalogue audit data {}.tsv'.format(now)), mode='w', encoding='utf-8', errors='replace')
-    ofile.write('YEAR\t' + '\t\t\t\t\t\t\t\t\t\t\t\t'.join(sorted(stats.fmt)) + '\n')
-    for i in range(0, len(stats.fmt)):
-        ofile.write('\tTotal\t008 Date\t008 Country\t008 Language\t\'082\t337 unmediated\t337 computer\tOther 337'
-                    '\t6XX\t920/LEO $a MP1\t920/LEO $a MP15\t920/LEO $a MP17')
-    ofile.write('\n')
-
-    for v in DATE_RANGES:
-        ofile.write('{}\t'.format(v))
-        for fmt in sorted(stats.fmt):
-            if fmt in stats.values[v]:
-                for w in stats.values[v][fmt].values:
-                    if stats.values[v][fmt].values[w] != 0:
-                        ofile.write(str(stats.values[v][fmt].values[w]))
-                    ofile.write('\t')
-        ofile.write('\n')   
-        
-    for year in sorted(stats.values, reverse=True):
-        if year not in DATE_RANGES:
-            ofile.write('{}\t'.format(str(year)))
-            for fmt in sorted(stats.fmt):
-                if fmt in stats.values[year]:
-                    for w in stats.values[year][fmt].values:
-                        if stats.values[year][fmt].values[w] != 0:
-                            ofile.write(str(stats.values[year][fmt].values[w]))
-                        ofile.write('\t')
-                else:
-                    for w in stats.values['Total for all years'][fmt].values:
-                        ofile.write('\t')
-            ofile.write('\n')             
-    ofile.close()            
+    if partial != '':
+        write_partial(partial, files, stats, evaluator, plugins, id_index)
+        print('\n\nPartial result saved to {}'.format(partial))
+    else:
+        write_outputs(output_folder, stats, evaluator, plugins, process_years,
+                      lambda e: sorted(stats.exclusions[e]),
+                      lambda: set().union(*stats.exclusions.values()))
 
     print('\n\nTransformation complete')
     print('----------------------------------------')